@@ -0,0 +1,207 @@
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
+from datasets import load_dataset
+from peft import PeftModel
+import torch
+import json
+import os
+import shutil
+import yaml
+
+
+with open("Training-config.yml", "r", encoding="utf-8") as file:
+    config = yaml.safe_load(file)
+
+model_name = config["model_name"]
+train_data_path = config["train_data_path"]
+lora_dir = config["output_lora_dir"]
+export_dir = config["export_dir"]
+
+merged_dir = os.path.join(export_dir, "bf16")
+quantized_dir = os.path.join(export_dir, config["quant_type"])
+manifest_path = os.path.join(export_dir, "manifest.json")
+
+#old manifest is removed first, so a disabled or failed export makes main.py fall back to base + new adapter
+if os.path.exists(manifest_path):
+    os.remove(manifest_path)
+
+if not config["export_merged"]:
+    print("Eksport scalonego modelu wyłączony (export_merged: False)")
+    raise SystemExit(0)
+
+tokenizer = AutoTokenizer.from_pretrained(lora_dir)
+tokenizer.pad_token = tokenizer.eos_token
+
+bnb_config = BitsAndBytesConfig(
+    load_in_4bit=config["load_in_4bit"],
+    bnb_4bit_use_double_quant=config["use_double_quant"],
+    bnb_4bit_quant_type=config["quant_type"],
+    bnb_4bit_compute_dtype=torch.bfloat16
+)
+
+#parity prompts are built the same way as in QLoRa.py preprocess_data
+dataset = load_dataset("json", data_files={"train": train_data_path})["train"]
+paritysamples = dataset.select(range(min(config["parity_samples"], len(dataset))))
+parityprompts = [f"Użytkownik: {example['user']}\nAsystent: {example['assistant']}" for example in paritysamples]
+generationprompts = [f"Użytkownik: {example['user']}\nAsystent:" for example in paritysamples]
+
+#returns list of logits tensors (one per parity prompt)
+@torch.no_grad()
+def compute_logits(model):
+    logits = []
+    for prompt in parityprompts:
+        inputs = tokenizer(prompt, return_tensors="pt", max_length=config["tokenizer_max_length"], truncation=True)
+        inputs = inputs.to(model.device)
+        logits.append(model(**inputs).logits.float().cpu())
+    return logits
+
+#returns list of greedy generations (new token ids only, one per generation prompt)
+@torch.no_grad()
+def greedy_generations(model):
+    generations = []
+    for prompt in generationprompts:
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        output = model.generate(
+            **inputs,
+            max_new_tokens=config["parity_max_new_tokens"],
+            do_sample=False,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id
+        )
+        generations.append(output[0][inputs["input_ids"].shape[1]:].tolist())
+    return generations
+
+#returns max absolute logits difference relative to the largest reference logit and share of positions with the same top-1 token
+def compare_logits(reference, candidate):
+    maxdiff = 0.0
+    maxlogit = 0.0
+    sametop = 0
+    positions = 0
+    for ref, cand in zip(reference, candidate):
+        maxdiff = max(maxdiff, (ref - cand).abs().max().item())
+        maxlogit = max(maxlogit, ref.abs().max().item())
+        sametop += (ref.argmax(dim=-1) == cand.argmax(dim=-1)).sum().item()
+        positions += ref.shape[1]
+    return maxdiff / maxlogit, sametop / positions
+
+#returns share of prompts with identical greedy generation
+def compare_generations(reference, candidate):
+    return sum(ref == cand for ref, cand in zip(reference, candidate)) / len(reference)
+
+#no return, frees cached GPU memory between model loads
+def release_gpu_memory():
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+#no return, replaces target dir with a fully written temporary dir
+def publish(tmpdir, targetdir):
+    if os.path.exists(targetdir):
+        shutil.rmtree(targetdir)
+    os.replace(tmpdir, targetdir)
+
+
+#current serving path (4-bit base + adapter), used as reference for greedy generations
+serving_base = AutoModelForCausalLM.from_pretrained(
+    model_name,
+    device_map="auto",
+    quantization_config=bnb_config
+)
+serving_model = PeftModel.from_pretrained(serving_base, lora_dir)
+serving_model.eval()
+servinggenerations = greedy_generations(serving_model)
+del serving_model, serving_base
+release_gpu_memory()
+
+#adapter is merged into full precision weights, merging into 4-bit weights would lose the LoRA delta
+base_model = AutoModelForCausalLM.from_pretrained(
+    model_name,
+    device_map="auto",
+    dtype=torch.bfloat16
+)
+model = PeftModel.from_pretrained(base_model, lora_dir)
+model.eval()
+
+referencelogits = compute_logits(model)
+referencegenerations = greedy_generations(model)
+
+merged_model = model.merge_and_unload()
+
+reldiff, top1 = compare_logits(referencelogits, compute_logits(merged_model))
+mergedgenerations = greedy_generations(merged_model)
+greedymatch = compare_generations(referencegenerations, mergedgenerations)
+servingmatch = compare_generations(servinggenerations, mergedgenerations)
+print(f"Parzystość bf16: względne max |Δlogits| = {reldiff:.5f}, zgodność top-1 = {top1:.4f}, "
+      f"zgodność generacji = {greedymatch:.4f} (z 4-bit + adapter: {servingmatch:.4f})")
+if reldiff > config["parity_rtol"] or top1 < config["parity_min_top1"] or greedymatch < config["parity_min_greedy_match"]:
+    raise RuntimeError(
+        f"Merged model differs from adapter model (relative max diff {reldiff:.5f}, top-1 agreement {top1:.4f}, "
+        f"greedy match {greedymatch:.4f})"
+    )
+
+merged_tmp_dir = merged_dir + ".tmp"
+shutil.rmtree(merged_tmp_dir, ignore_errors=True)
+merged_model.save_pretrained(merged_tmp_dir, safe_serialization=True)
+tokenizer.save_pretrained(merged_tmp_dir)
+
+manifest = {
+    "base_model": model_name,
+    "adapter": lora_dir,
+    "model_dir": "bf16",
+    "dtype": "bfloat16",
+    "quantization": None,
+    "parity": {
+        "bf16": {
+            "relative_max_logits_diff": reldiff,
+            "top1_agreement": top1,
+            "greedy_match": greedymatch,
+            "greedy_match_4bit_adapter": servingmatch
+        }
+    }
+}
+
+del merged_model, model, base_model
+release_gpu_memory()
+
+if config["export_quantized"]:
+    quantized_model = AutoModelForCausalLM.from_pretrained(
+        merged_tmp_dir,
+        device_map="auto",
+        quantization_config=bnb_config
+    )
+    quantized_model.eval()
+
+    #quantizing W + BA can round the LoRA delta away, the 4-bit export is only served
+    #when its greedy generations match the current serving path (4-bit base + bf16 adapter)
+    reldiff, top1 = compare_logits(referencelogits, compute_logits(quantized_model))
+    servingmatch = compare_generations(servinggenerations, greedy_generations(quantized_model))
+    print(f"Parzystość {config['quant_type']}: względne max |Δlogits| = {reldiff:.5f}, zgodność top-1 = {top1:.4f}, "
+          f"zgodność generacji z 4-bit + adapter = {servingmatch:.4f}")
+    manifest["parity"][config["quant_type"]] = {
+        "relative_max_logits_diff": reldiff,
+        "top1_agreement": top1,
+        "greedy_match_4bit_adapter": servingmatch
+    }
+
+    if servingmatch >= config["parity_min_greedy_match"]:
+        quantized_tmp_dir = quantized_dir + ".tmp"
+        shutil.rmtree(quantized_tmp_dir, ignore_errors=True)
+        quantized_model.save_pretrained(quantized_tmp_dir, safe_serialization=True)
+        tokenizer.save_pretrained(quantized_tmp_dir)
+
+        publish(quantized_tmp_dir, quantized_dir)
+        print(f"Skwantyzowany model zapisany w: {quantized_dir}")
+
+        manifest["model_dir"] = config["quant_type"]
+        manifest["quantization"] = config["quant_type"]
+    else:
+        print("Skwantyzowany model odrzucony, manifest wskazuje model bf16")
+
+    del quantized_model
+    release_gpu_memory()
+
+publish(merged_tmp_dir, merged_dir)
+print(f"Scalony model zapisany w: {merged_dir}")
+
+#manifest is written last, only after all weights passed the parity checks
+with open(manifest_path, "w", encoding="utf-8") as file:
+    json.dump(manifest, file, indent=2)
+print(f"Manifest zapisany w: {manifest_path}")
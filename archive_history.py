@@ -0,0 +1,28 @@
+from modules.db import ensure_history_partitions, archive_history
+import time
+import yaml
+
+with open("LLM-config.yml", "r", encoding="utf-8") as file:
+    config = yaml.safe_load(file)
+
+interval = config["history_maintenance_interval"]
+
+
+#no return, creates upcoming partitions and archives partitions older than retention
+def maintain_history():
+    ensure_history_partitions(config["history_partitions_ahead"])
+    archived = archive_history(config["history_retention_months"])
+    print(f"Zarchiwizowano {archived} partycji historii")
+
+
+if __name__ == "__main__":
+    while True:
+        try:
+            maintain_history()
+        except Exception as e:
+            if not interval:
+                raise
+            print(f"Błąd obsługi partycji historii: {e}")
+        if not interval:
+            break
+        time.sleep(interval)
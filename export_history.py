@@ -0,0 +1,89 @@
+from modules.db import iter_rated_history
+from datetime import datetime, timedelta, timezone
+import hashlib
+import json
+import os
+import time
+import yaml
+
+with open("LLM-config.yml", "r", encoding="utf-8") as file:
+    config = yaml.safe_load(file)
+
+export_path = config["history_export_path"]
+state_path = config["history_export_state_path"]
+hashes_path = config["history_export_hashes_path"]
+chunk_size = config["history_export_chunk_size"]
+interval = config["history_export_interval"]
+overlap = timedelta(seconds=config["history_export_overlap_seconds"])
+
+
+#returns rating time of the last exported row (unix epoch if nothing was exported yet)
+def load_watermark():
+    if not os.path.exists(state_path):
+        return datetime(1970, 1, 1, tzinfo=timezone.utc)
+    with open(state_path, "r", encoding="utf-8") as file:
+        return datetime.fromisoformat(json.load(file)["rated_at"])
+
+#no return, state file is replaced atomically so a crash never leaves it half written
+def save_watermark(ratedat: datetime):
+    tmppath = state_path + ".tmp"
+    with open(tmppath, "w", encoding="utf-8") as file:
+        json.dump({"rated_at": ratedat.isoformat()}, file)
+    os.replace(tmppath, state_path)
+
+#returns set of hashes of already exported pairs
+def load_hashes():
+    if not os.path.exists(hashes_path):
+        return set()
+    with open(hashes_path, "r", encoding="utf-8") as file:
+        return {line.strip() for line in file if line.strip()}
+
+#returns hash of (user, assistant) pair used for deduplication
+def pair_hash(usermessage: str, llmmessage: str):
+    return hashlib.sha256(f"{usermessage.strip()}\0{llmmessage.strip()}".encode("utf-8")).hexdigest()
+
+#returns number of pairs written, rows are flushed and watermark saved after every chunk
+#rows rated within overlap before the watermark are read again (ratings committed late), hash dedup skips repeats
+def export_rated_history():
+    lastratedat = load_watermark()
+    hashes = load_hashes()
+    written = 0
+    pending = 0
+
+    with open(export_path, "a", encoding="utf-8") as out, open(hashes_path, "a", encoding="utf-8") as hashout:
+        for row in iter_rated_history(lastratedat - overlap, chunk_size):
+            lastratedat = row["rated_at"]
+            pending += 1
+
+            rowhash = pair_hash(row["usermessage"], row["llmmessage"])
+            if rowhash not in hashes:
+                hashes.add(rowhash)
+                out.write(json.dumps({"user": row["usermessage"], "assistant": row["llmmessage"]}, ensure_ascii=False) + "\n")
+                hashout.write(rowhash + "\n")
+                written += 1
+
+            if pending >= chunk_size:
+                out.flush()
+                hashout.flush()
+                save_watermark(lastratedat)
+                pending = 0
+
+        out.flush()
+        hashout.flush()
+        save_watermark(lastratedat)
+
+    return written
+
+
+if __name__ == "__main__":
+    while True:
+        try:
+            count = export_rated_history()
+            print(f"Wyeksportowano {count} nowych par do: {export_path}")
+        except Exception as e:
+            if not interval:
+                raise
+            print(f"Błąd eksportu historii: {e}")
+        if not interval:
+            break
+        time.sleep(interval)
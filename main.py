@@ -1,16 +1,17 @@
-from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline, BitsAndBytesConfig
+from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig
 from modules.db import add_user, add_conversation, add_history, add_history_rate, get_conversations_by_user, \
-    get_history, revoke_refresh_token, get_conversation_by_history
+    get_history, revoke_refresh_token, get_conversation_by_history, ensure_history_partitions
 from peft import PeftModel
 import torch
-from langchain.memory import ConversationBufferMemory
-from langchain.schema import HumanMessage, AIMessage
 from modules.models import Message, UserCreate, LoginRequest, HistoryRate, RefreshRequest
 from fastapi import FastAPI, Depends, HTTPException, Body
 from modules.security import login_user, require_role, new_access_token
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
 import os
+import json
+from collections import OrderedDict
+import threading
 import yaml
 from langdetect import detect
 import uvicorn
@@ -19,6 +20,7 @@ with open("LLM-config.yml", "r", encoding="utf-8") as file:
     config = yaml.safe_load(file)
 
 lora_checkpoint_path = config["lora_checkpoint_path"]
+merged_manifest_path = config["merged_manifest_path"]
 model_name = config["model_name"]
 app = FastAPI()
 
@@ -32,6 +34,12 @@ app.add_middleware(
 
 ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
 
+#partition errors must not stop the API, history_default keeps accepting rows until the next maintenance run
+try:
+    ensure_history_partitions(config["history_partitions_ahead"])
+except Exception as e:
+    print(f"Nie udało się utworzyć partycji historii: {e}")
+
 tokenizer = AutoTokenizer.from_pretrained(model_name)
 tokenizer.pad_token = tokenizer.eos_token
 
@@ -50,86 +58,111 @@ else:
     device_map = "cpu"
     dtype = torch.float16
 
-base_model = AutoModelForCausalLM.from_pretrained(
-    model_name,
-    quantization_config=bnb_config,
-    device_map=device_map,
-    dtype=dtype
-)
+#merged model exported by Traning-app/export.py is served directly, without the PeftModel adapter layers
+if merged_manifest_path and os.path.exists(merged_manifest_path):
+    with open(merged_manifest_path, "r", encoding="utf-8") as file:
+        manifest = json.load(file)
+
+    merged_model_path = os.path.join(os.path.dirname(merged_manifest_path), manifest["model_dir"])
+    #quantized export keeps its quantization config in config.json, bf16 export is served unquantized
+    #(quantizing W + BA at load would round the LoRA delta away)
+    model = AutoModelForCausalLM.from_pretrained(
+        merged_model_path,
+        device_map=device_map,
+        dtype=dtype
+    )
+else:
+    base_model = AutoModelForCausalLM.from_pretrained(
+        model_name,
+        quantization_config=bnb_config,
+        device_map=device_map,
+        dtype=dtype
+    )
 
-model = PeftModel.from_pretrained(base_model, lora_checkpoint_path)
-pipe = pipeline("text-generation", model=model, tokenizer=tokenizer, device_map=device_map)
+    model = PeftModel.from_pretrained(base_model, lora_checkpoint_path)
 
+#(user tag, assistant tag) used in prompts, selected by detected language
+PROMPT_TAGS = {
+    "pl": ("Użytkownik:", "Asystent:"),
+    "en": ("User:", "Assistant:")
+}
+
+#special tokens the tokenizer puts in front of every prompt (e.g. begin_of_text)
+prefix_ids = tokenizer("")["input_ids"]
+
+#system prompt is tokenized once per language
+system_prompt_ids = {
+    lang: prefix_ids + tokenizer(f"System: {config[f'system_prompt_{lang}']}\n", add_special_tokens=False)["input_ids"]
+    for lang in PROMPT_TAGS
+}
+
+
+#returns "pl" or "en" prompt language of text
+def prompt_lang(text):
+    return "pl" if detect(text) == "pl" else "en"
+
+
+#token ids of history rows keyed by history id, rows are immutable apart from rating which isn't part of the prompt
+history_ids_cache = OrderedDict()
+history_ids_cache_lock = threading.Lock()
 
-def generate_response(userinput, conversationid):
-    if config["history_length"] == "max":
-        memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True)
-    else:
-        memory = ConversationBufferMemory(memory_key="chat_history", return_messages=True, k=config["history_length"])
 
+#returns token ids of one history row (user and assistant lines), cached per history id
+def history_row_ids(row):
+    with history_ids_cache_lock:
+        ids = history_ids_cache.get(row["id"])
+        if ids is not None:
+            history_ids_cache.move_to_end(row["id"])
+            return ids
+
+    usertag = PROMPT_TAGS[prompt_lang(row["usermessage"])][0]
+    assistanttag = PROMPT_TAGS[prompt_lang(row["llmmessage"])][1]
+    ids = tuple(
+        tokenizer(f"{usertag} {row['usermessage']}\n{assistanttag} {row['llmmessage']}\n", add_special_tokens=False)["input_ids"]
+    )
+
+    with history_ids_cache_lock:
+        history_ids_cache[row["id"]] = ids
+        if len(history_ids_cache) > config["history_cache_size"]:
+            history_ids_cache.popitem(last=False)
+    return ids
+
+
+def generate_response(userinput, conversationid):
     history = get_history(conversationid)
+    if config["history_length"] != "max":
+        history = history[-config["history_length"]:] if config["history_length"] > 0 else []
+
+    lang = prompt_lang(userinput)
+    user_tag, assistant_tag = PROMPT_TAGS[lang]
+
+    inputids = list(system_prompt_ids[lang])
     for row in history:
-        memory.chat_memory.add_message(HumanMessage(content=row["usermessage"]))
-        memory.chat_memory.add_message(AIMessage(content=row["llmmessage"]))
-
-    chathistorytext = ""
-    for m in memory.load_memory_variables({})["chat_history"]:
-        historylang = detect(m.content)
-        if historylang == "pl":
-            if m.type == "human":
-                chathistorytext += f"Użytkownik: {m.content}\n"
-            else:
-                chathistorytext += f"Asystent: {m.content}\n"
-        else:
-            if m.type == "human":
-                chathistorytext += f"User: {m.content}\n"
-            else:
-                chathistorytext += f"Assistant: {m.content}\n"
-
-    lang = detect(userinput)
-    if lang == "pl":
-        system_prompt = config["system_prompt_pl"]
-        assistant_tag = "Asystent:"
-        user_tag = "Użytkownik:"
-        prompt = (
-            f"System: {system_prompt}\n"
-            f"{chathistorytext}"
-            f"Użytkownik: {userinput}\n"
-            f"Asystent:"
-        )
-    else:
-        system_prompt = config["system_prompt_en"]
-        assistant_tag = "Assistant:"
-        user_tag = "User:"
-        prompt = (
-            f"System: {system_prompt}\n"
-            f"{chathistorytext}"
-            f"User: {userinput}\n"
-            f"Assistant:"
+        inputids.extend(history_row_ids(row))
+    inputids.extend(tokenizer(f"{user_tag} {userinput}\n{assistant_tag}", add_special_tokens=False)["input_ids"])
+
+    inputtensor = torch.tensor([inputids], device=model.device)
+    with torch.no_grad():
+        output = model.generate(
+            input_ids=inputtensor,
+            attention_mask=torch.ones_like(inputtensor),
+            max_new_tokens=config["max_new_tokens"],
+            do_sample=config["do_sample"],
+            temperature=config["temperature"],
+            top_p=config["top_p"],
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id
         )
-    output = pipe(
-        prompt,
-        max_new_tokens=config["max_new_tokens"],
-        do_sample=config["do_sample"],
-        temperature=config["temperature"],
-        top_p=config["top_p"],
-        eos_token_id=tokenizer.eos_token_id
-    )
-
-    generatedtext = output[0]["generated_text"]
 
-    if assistant_tag in generatedtext:
-        assistantreply = generatedtext.split(assistant_tag)[-1]
-    else:
-        assistantreply = generatedtext
+    #only newly generated tokens are decoded
+    assistantreply = tokenizer.decode(output[0][inputtensor.shape[1]:], skip_special_tokens=True)
 
+    #cut off turns the model invents after its reply
     if user_tag in assistantreply:
         assistantreply = assistantreply.split(user_tag)[0]
 
     reply = assistantreply.strip()
 
-    del memory
-
     return reply
 
 
@@ -217,7 +250,7 @@ def rate(historyid: int, hist: HistoryRate, auth=Depends(require_role(["admin",
     if not any(conv["id"] == conversationid["conversation_id"] for conv in conversations):
         raise HTTPException(status_code=406, detail="Access denied")
 
-    countrowsaffected = add_history_rate(historyid, hist.rate)
+    countrowsaffected = add_history_rate(historyid, conversationid["created"], hist.rate)
     return {
         "historyid": historyid,
         "countrowsaffected": countrowsaffected
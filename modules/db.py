@@ -126,13 +126,14 @@ def add_history(conversationid: int, usermessage: str, llmmessage: str):
     return histid
 
 #returns numer of affected rows (1 row = history rate updated, 0 row = couldn't find history)
-def add_history_rate(historyid: int, rate: bool):
+#created (from get_conversation_by_history) limits the update to a single history partition
+def add_history_rate(historyid: int, created: datetime, rate: bool):
     conn = get_connection()
     cur = conn.cursor()
     try:
         cur.execute(
-            "UPDATE history SET rating = %s WHERE id = %s",
-            (rate, historyid)
+            "UPDATE history SET rating = %s, rated_at = clock_timestamp() WHERE id = %s AND created = %s",
+            (rate, historyid, created)
         )
         conn.commit()
     finally:
@@ -144,9 +145,14 @@ def add_history_rate(historyid: int, rate: bool):
 def get_history(conversationid: int):
     conn = get_connection()
     cur = conn.cursor()
+    #created lower bound (history can't be older than its conversation) lets postgres prune older partitions
     cur.execute(
-        "SELECT id, usermessage, llmmessage, rating, created FROM history WHERE conversation_id = (%s) ORDER BY created ASC",
-        (conversationid,)
+        "SELECT id, usermessage, llmmessage, rating, created FROM history WHERE conversation_id = (%s) "
+        "AND created >= (SELECT COALESCE(created, '-infinity') FROM conversations WHERE id = (%s)) "
+        "UNION ALL "
+        "SELECT id, usermessage, llmmessage, rating, created FROM history_archive WHERE conversation_id = (%s) "
+        "ORDER BY created ASC",
+        (conversationid, conversationid, conversationid)
     )
     history = cur.fetchall()
     conn.commit()
@@ -154,12 +160,12 @@ def get_history(conversationid: int):
     conn.close()
     return history
 
-#returns conversation id by history id
+#returns conversation id and created of history row by history id
 def get_conversation_by_history(historyid: int):
     conn = get_connection()
     cur = conn.cursor()
     cur.execute(
-        "SELECT id, conversation_id FROM history WHERE id = (%s)",
+        "SELECT id, conversation_id, created FROM history WHERE id = (%s)",
         (historyid,)
     )
     history = cur.fetchone()
@@ -215,4 +221,56 @@ def get_active_refresh_token_by_user(userid: int):
     tokenobj = cur.fetchone()
     cur.close()
     conn.close()
-    return tokenobj
\ No newline at end of file
+    return tokenobj
+
+#yields positively rated history rows rated at or after ratedsince, streamed from a server-side cursor
+def iter_rated_history(ratedsince: datetime, chunksize: int = 1000):
+    conn = get_connection()
+    cur = conn.cursor(name="rated_history_export")
+    cur.itersize = chunksize
+    try:
+        cur.execute(
+            "SELECT id, usermessage, llmmessage, rated_at FROM history WHERE rating = TRUE AND rated_at >= %s "
+            "UNION ALL "
+            "SELECT id, usermessage, llmmessage, rated_at FROM history_archive WHERE rating = TRUE AND rated_at >= %s "
+            "ORDER BY rated_at ASC, id ASC",
+            (ratedsince, ratedsince)
+        )
+        for row in cur:
+            yield row
+    finally:
+        cur.close()
+        conn.close()
+
+
+#no return, creates missing monthly history partitions
+def ensure_history_partitions(monthsahead: int):
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT create_history_partitions(%s)", (monthsahead,))
+        conn.commit()
+    finally:
+        cur.close()
+        conn.close()
+
+#returns number of history partitions moved to history_archive, each partition in its own transaction
+def archive_history(retentionmonths: int):
+    conn = get_connection()
+    cur = conn.cursor()
+    archived = 0
+    try:
+        while True:
+            cur.execute(
+                "SELECT archive_history_partitions(make_interval(months => %s)) AS partition",
+                (retentionmonths,)
+            )
+            partition = cur.fetchone()["partition"]
+            conn.commit()
+            if partition is None:
+                break
+            archived += 1
+    finally:
+        cur.close()
+        conn.close()
+    return archived
\ No newline at end of file
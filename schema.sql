@@ -16,14 +16,117 @@ CREATE TABLE conversations (
 );
 
 CREATE TABLE history (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     conversation_id INT NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
-    created TIMESTAMPTZ DEFAULT NOW(),
+    created TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     usermessage TEXT NOT NULL,
     llmmessage TEXT NOT NULL,
-    rating BOOLEAN
+    rating BOOLEAN,
+    rated_at TIMESTAMPTZ,
+    PRIMARY KEY (id, created)
+) PARTITION BY RANGE (created);
+
+CREATE INDEX history_conversation_created_idx ON history (conversation_id, created);
+CREATE INDEX history_rated_at_idx ON history (rated_at, id) WHERE rating = TRUE;
+
+CREATE TABLE history_default PARTITION OF history DEFAULT;
+
+CREATE TABLE history_archive (
+    id INT PRIMARY KEY,
+    conversation_id INT NOT NULL REFERENCES conversations(id) ON DELETE CASCADE,
+    created TIMESTAMPTZ NOT NULL,
+    usermessage TEXT NOT NULL,
+    llmmessage TEXT NOT NULL,
+    rating BOOLEAN,
+    rated_at TIMESTAMPTZ
 );
 
+CREATE INDEX history_archive_conversation_created_idx ON history_archive (conversation_id, created);
+CREATE INDEX history_archive_rated_at_idx ON history_archive (rated_at, id) WHERE rating = TRUE;
+
+-- creates monthly history partitions (UTC) from the current month up to monthsahead months ahead,
+-- and for every month that already has rows in history_default; those rows are moved into the new partitions
+CREATE FUNCTION create_history_partitions(monthsahead INT) RETURNS VOID AS $$
+DECLARE
+    monthstart TIMESTAMP;
+    partname TEXT;
+    defaultdetached BOOLEAN := FALSE;
+BEGIN
+    FOR monthstart IN
+        SELECT date_trunc('month', NOW() AT TIME ZONE 'UTC') + make_interval(months => i)
+        FROM generate_series(0, monthsahead) AS i
+        UNION
+        SELECT DISTINCT date_trunc('month', created AT TIME ZONE 'UTC') FROM history_default
+        ORDER BY 1
+    LOOP
+        partname := 'history_' || to_char(monthstart, 'YYYY_MM');
+        CONTINUE WHEN to_regclass(partname) IS NOT NULL;
+
+        -- a new range can't be attached while the default partition may hold rows from it
+        IF NOT defaultdetached THEN
+            ALTER TABLE history DETACH PARTITION history_default;
+            defaultdetached := TRUE;
+        END IF;
+
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF history FOR VALUES FROM (%L) TO (%L)',
+            partname,
+            monthstart::TEXT || '+00',
+            (monthstart + INTERVAL '1 month')::TEXT || '+00'
+        );
+    END LOOP;
+
+    IF defaultdetached THEN
+        -- every month present in history_default has its own partition now
+        WITH moved AS (
+            DELETE FROM history_default
+            RETURNING id, conversation_id, created, usermessage, llmmessage, rating, rated_at
+        )
+        INSERT INTO history (id, conversation_id, created, usermessage, llmmessage, rating, rated_at)
+        SELECT id, conversation_id, created, usermessage, llmmessage, rating, rated_at FROM moved;
+
+        ALTER TABLE history ATTACH PARTITION history_default DEFAULT;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- moves the oldest monthly history partition older than retention into history_archive,
+-- returns its name (NULL when nothing is left to archive); call once per transaction so the
+-- exclusive lock on history is only held for the short DETACH and DROP, not for the copy
+CREATE FUNCTION archive_history_partitions(retention INTERVAL) RETURNS TEXT AS $$
+DECLARE
+    partname TEXT;
+BEGIN
+    SELECT c.relname INTO partname
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = 'history'::REGCLASS
+      AND c.relname ~ '^history_[0-9]{4}_[0-9]{2}$'
+      AND to_date(substring(c.relname FROM 9), 'YYYY_MM') + INTERVAL '1 month'
+          <= (NOW() AT TIME ZONE 'UTC') - retention
+    ORDER BY c.relname
+    LIMIT 1;
+
+    IF partname IS NULL THEN
+        RETURN NULL;
+    END IF;
+
+    -- blocks only writes to this (cold) partition while it is copied
+    EXECUTE format('LOCK TABLE %I IN SHARE MODE', partname);
+    EXECUTE format(
+        'INSERT INTO history_archive (id, conversation_id, created, usermessage, llmmessage, rating, rated_at) '
+        'SELECT id, conversation_id, created, usermessage, llmmessage, rating, rated_at FROM %I',
+        partname
+    );
+    EXECUTE format('ALTER TABLE history DETACH PARTITION %I', partname);
+    EXECUTE format('DROP TABLE %I', partname);
+    RETURN partname;
+END;
+$$ LANGUAGE plpgsql;
+
+-- initial partitions only, the backend and archive_history.py keep history_partitions_ahead (LLM-config.yml) months ready
+SELECT create_history_partitions(3);
+
 CREATE TABLE refresh_tokens (
     id SERIAL PRIMARY KEY,
     user_id INTEGER NOT NULL REFERENCES users(id),